@@ -1,19 +1,31 @@
+import hashlib
 import shutil
 import subprocess
+import sys
+import tarfile
 import tempfile
-from filecmp import dircmp
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
+import filecmp
 from pathlib import Path
 import os
 
+import h5py
 import numpy as np
+from numba import njit
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.offline import init_notebook_mode
+from IPython import get_ipython
+from IPython.display import display
 import random
 import plotly.colors as pc
 import matplotlib.pyplot as plt
 from plotly.subplots import make_subplots
 import logging
+import warnings
 
 init_notebook_mode()
 
@@ -25,6 +37,13 @@ CONFIG = {
     'temp_dir_prefix': 'ref_compare_',
 }
 
+# Logarithmic bins for the relative-difference histogram kept per changed key
+REL_DIFF_BIN_EDGES = np.logspace(-12, 2, 64)
+
+# HDF5 (and PyTables on top of it) is not thread-safe, so every call into the
+# library is serialised through this lock when files are compared in parallel
+HDF5_LOCK = threading.Lock()
+
 # Utility functions
 def color_print(text, color):
     colors = {
@@ -39,6 +58,75 @@ def color_print(text, color):
 def get_relative_path(path, base):
     return str(Path(path).relative_to(base))
 
+@contextmanager
+def locked_hdf(opener, *args, **kwargs):
+    """Open an HDF5 handle, holding HDF5_LOCK while it is opened and closed."""
+    with HDF5_LOCK:
+        handle = opener(*args, **kwargs)
+    try:
+        yield handle
+    finally:
+        with HDF5_LOCK:
+            handle.close()
+
+@njit(nogil=True, cache=True)
+def diff_stats(a, b, bin_edges):
+    """Per-column sums, maxima and counts of the absolute and relative differences of two 2D arrays.
+
+    The relative difference is |a - b| / max(|a|, |b|). Everything is accumulated
+    in a single pass without temporary arrays; NaN differences and entries where
+    both values are zero are skipped, as ``np.nanmean``/``np.nanmax`` would.
+    A histogram of the relative differences over ``bin_edges`` is returned as
+    well, following ``np.histogram`` conventions.
+    The GIL is released so files compared in worker threads run concurrently.
+    """
+    n_rows, n_cols = a.shape
+    abs_sum = np.zeros(n_cols)
+    abs_max = np.full(n_cols, -np.inf)
+    abs_count = np.zeros(n_cols, dtype=np.int64)
+    rel_sum = np.zeros(n_cols)
+    rel_max = np.full(n_cols, -np.inf)
+    rel_count = np.zeros(n_cols, dtype=np.int64)
+    n_bins = len(bin_edges) - 1
+    rel_hist = np.zeros(n_bins, dtype=np.int64)
+
+    for j in range(n_cols):
+        for i in range(n_rows):
+            x = a[i, j]
+            y = b[i, j]
+            d = abs(x - y)
+            if np.isnan(d):
+                continue
+            abs_sum[j] += d
+            abs_count[j] += 1
+            if d > abs_max[j]:
+                abs_max[j] = d
+
+            denominator = max(abs(x), abs(y))
+            if denominator == 0:
+                continue
+            r = d / denominator
+            if np.isnan(r):
+                continue
+            rel_sum[j] += r
+            rel_count[j] += 1
+            if r > rel_max[j]:
+                rel_max[j] = r
+            if bin_edges[0] <= r <= bin_edges[n_bins]:
+                rel_hist[min(np.searchsorted(bin_edges, r, side='right') - 1, n_bins - 1)] += 1
+
+    return abs_sum, abs_max, abs_count, rel_sum, rel_max, rel_count, rel_hist
+
+def same_file_contents(path1, path2, chunk_size=1 << 20):
+    """Compare two files byte by byte, stopping at the first differing chunk."""
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            chunk1, chunk2 = f1.read(chunk_size), f2.read(chunk_size)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
 def get_last_two_commits():
     try:
         result = subprocess.run(['git', 'log', '--format=%H', '-n', '2'], 
@@ -80,66 +168,175 @@ class FileSetup:
         self.ref2_hash = ref2_hash
 
     def setup(self):
-        for ref_id, ref_hash in enumerate([self.ref1_hash, self.ref2_hash], 1):
-            ref_dir = self.file_manager.get_temp_path(f"ref{ref_id}")
-            os.makedirs(ref_dir, exist_ok=True)
-            if ref_hash:
-                self._copy_data_from_hash(ref_hash, ref_dir)
-            else:
-                subprocess.run(f'cp -r {CONFIG["compare_path"]}/* {ref_dir}', shell=True)
+        # Both references are extracted concurrently, they do not share any files
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = []
+            for ref_id, ref_hash in enumerate([self.ref1_hash, self.ref2_hash], 1):
+                ref_dir = self.file_manager.get_temp_path(f"ref{ref_id}")
+                os.makedirs(ref_dir, exist_ok=True)
+                if ref_hash:
+                    futures.append(executor.submit(self._copy_data_from_hash, ref_hash, ref_dir))
+                else:
+                    futures.append(executor.submit(self._copy_working_tree, ref_dir))
+            for future in futures:
+                future.result()
+
+    def _copy_working_tree(self, ref_dir):
+        # Top-level hidden entries such as .git are skipped, as the previous `cp -r path/*` did
+        with os.scandir(CONFIG["compare_path"]) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                destination = os.path.join(ref_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.copytree(entry.path, destination, symlinks=True, dirs_exist_ok=True)
+                else:
+                    shutil.copy2(entry.path, destination, follow_symlinks=False)
+
+    def get_changed_paths(self):
+        """Return the paths git reports as changed between the two references.
+
+        Returns None when either reference is the working tree or git fails, in
+        which case files have to be compared on disk.
+        """
+        if not (self.ref1_hash and self.ref2_hash):
+            return None
+        try:
+            # --relative matches the paths of `git archive`, which only covers the current directory
+            result = subprocess.run(['git', 'diff', '--name-only', '--relative', '--no-renames', '-z', self.ref1_hash, self.ref2_hash],
+                                    capture_output=True,
+                                    text=True,
+                                    check=True)
+        except (subprocess.SubprocessError, subprocess.CalledProcessError):
+            print("Error: Unable to get changed files from git.")
+            return None
+        return set(filter(None, result.stdout.split('\0')))
 
     def _copy_data_from_hash(self, ref_hash, ref_dir):
-        git_cmd = ['git', 'archive', ref_hash, '|', 'tar', '-x', '-C', str(ref_dir)]
-        subprocess.run(' '.join(git_cmd), shell=True)
+        # The archive is streamed straight into the extractor, without a shell or tar process
+        with subprocess.Popen(['git', 'archive', '--format=tar', ref_hash], stdout=subprocess.PIPE) as process:
+            try:
+                with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+                    archive.extractall(ref_dir, filter='tar')
+            except tarfile.ReadError:
+                # An empty stream means git failed, which is reported below
+                if process.wait() == 0:
+                    raise
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+class DirComparison:
+    """Compare two directory trees, exposing the same attributes as ``filecmp.dircmp``.
+
+    Both sides are listed once with ``os.scandir`` and the ``DirEntry`` objects are
+    kept, so file type checks later on do not need extra ``stat`` calls. When
+    ``changed_paths`` (paths relative to the compared roots) is given, common files
+    are different exactly when listed there and are never read.
+    """
+
+    def __init__(self, left, right, ignore=None, changed_paths=None, prefix=''):
+        self.left = left
+        self.right = right
+        self.ignore = filecmp.DEFAULT_IGNORES if ignore is None else ignore
+        self.changed_paths = changed_paths
+        self.prefix = prefix
+        self.left_entries = self._scan(left)
+        self.right_entries = self._scan(right)
+
+        left_names, right_names = set(self.left_entries), set(self.right_entries)
+        self.left_only = sorted(left_names - right_names)
+        self.right_only = sorted(right_names - left_names)
+        common = sorted(left_names & right_names)
+        self.common_dirs = [
+            name for name in common
+            if self.left_entries[name].is_dir() and self.right_entries[name].is_dir()
+        ]
+        self.common_files = [
+            name for name in common
+            if self.left_entries[name].is_file() and self.right_entries[name].is_file()
+        ]
+        self.subdirs = {
+            name: DirComparison(
+                self.left_entries[name].path,
+                self.right_entries[name].path,
+                self.ignore,
+                changed_paths,
+                f"{prefix}{name}/",
+            )
+            for name in self.common_dirs
+        }
+
+    def _scan(self, path):
+        with os.scandir(path) as it:
+            return {entry.name: entry for entry in it if entry.name not in self.ignore}
+
+    @cached_property
+    def diff_files(self):
+        return [name for name in self.common_files if not self._same_file(name)]
+
+    def _same_file(self, name):
+        if self.changed_paths is not None:
+            return f"{self.prefix}{name}" not in self.changed_paths
+        left_stat = self.left_entries[name].stat()
+        right_stat = self.right_entries[name].stat()
+        if left_stat.st_size != right_stat.st_size:
+            return False
+        if left_stat.st_mtime == right_stat.st_mtime:
+            return True
+        # Checkouts from git carry the commit time as mtime, so same-sized files
+        # from different commits still need their contents compared
+        return same_file_contents(self.left_entries[name].path, self.right_entries[name].path)
 
 class DiffAnalyzer:
     def __init__(self, file_manager):
         self.file_manager = file_manager
 
     def display_diff_tree(self, dcmp, prefix=''):
-        for item in sorted(dcmp.left_only):
-            path = Path(dcmp.left) / item
-            self._print_item(f'{prefix}−', item, 'red', path.is_dir())
+        # DirComparison already keeps its name lists sorted
+        left_entries, right_entries, subdirs = dcmp.left_entries, dcmp.right_entries, dcmp.subdirs
+        removed, added, modified = f'{prefix}−', f'{prefix}+', f'{prefix}✱'
+        directory, child_prefix = f'{prefix}├', prefix + '│ '
 
-        for item in sorted(dcmp.right_only):
-            path = Path(dcmp.right) / item
-            self._print_item(f'{prefix}+', item, 'green', path.is_dir())
+        for item in dcmp.left_only:
+            self._print_item(removed, item, 'red', left_entries[item].is_dir())
 
-        for item in sorted(dcmp.diff_files):
-            self._print_item(f'{prefix}✱', item, 'yellow')
+        for item in dcmp.right_only:
+            self._print_item(added, item, 'green', right_entries[item].is_dir())
 
-        for item in sorted(dcmp.common_dirs):
-            self._print_item(f'{prefix}├', item, 'blue', True)
-            subdir = getattr(dcmp, 'subdirs')[item]
-            self.display_diff_tree(subdir, prefix + '│ ')
+        for item in dcmp.diff_files:
+            self._print_item(modified, item, 'yellow')
+
+        for item in dcmp.common_dirs:
+            self._print_item(directory, item, 'blue', True)
+            self.display_diff_tree(subdirs[item], child_prefix)
 
     def _print_item(self, symbol, item, color, is_dir=False):
         dir_symbol = '/' if is_dir else ''
         color_print(f"{symbol} {item}{dir_symbol}", color)
 
     def print_diff_files(self, dcmp):
-        dcmp.right = Path(dcmp.right)
-        dcmp.left = Path(dcmp.left)
-        
-        self._print_new_files(dcmp.right_only, dcmp.right, "ref1")
-        self._print_new_files(dcmp.left_only, dcmp.left, "ref2")
+        self._print_new_files(dcmp.right_only, dcmp.right_entries, "ref1")
+        self._print_new_files(dcmp.left_only, dcmp.left_entries, "ref2")
         self._print_modified_files(dcmp)
 
         for sub_dcmp in dcmp.subdirs.values():
             self.print_diff_files(sub_dcmp)
 
-    def _print_new_files(self, files, path, ref):
+    def _print_new_files(self, files, entries, ref):
         for item in files:
-            if Path(path, item).is_file():
+            entry = entries[item]
+            if entry.is_file():
                 print(f"New file detected inside {ref}: {item}")
-                print(f"Path: {Path(path, item)}")
+                print(f"Path: {entry.path}")
                 print()
 
     def _print_modified_files(self, dcmp):
+        if not dcmp.diff_files:
+            return
+        left = self._get_relative_path(dcmp.left)
+        right = self._get_relative_path(dcmp.right)
         for name in dcmp.diff_files:
             print(f"Modified file found {name}")
-            left = self._get_relative_path(dcmp.left)
-            right = self._get_relative_path(dcmp.right)
             if left == right:
                 print(f"Path: {left}")
             print()
@@ -156,57 +353,273 @@ class HDFComparator:
         self.print_path = print_path
 
     def summarise_changes_hdf(self, name, path1, path2):
-        ref1 = pd.HDFStore(Path(path1) / name)
-        ref2 = pd.HDFStore(Path(path2) / name)
-        k1, k2 = set(ref1.keys()), set(ref2.keys())
-        
+        results, differences = self.compare_hdf(name, path1, path2)
+        self.report_changes_hdf(name, path1, path2, results, differences)
+        return results
+
+    def compare_hdf(self, name, path1, path2):
+        """Compare two HDF files without printing or displaying anything.
+
+        Returns the results dictionary and the per-key differences that
+        ``report_changes_hdf`` displays. Safe to call from worker threads.
+        """
+        with locked_hdf(h5py.File, Path(path1) / name, 'r') as f1, locked_hdf(h5py.File, Path(path2) / name, 'r') as f2:
+            with HDF5_LOCK:
+                groups1, groups2 = self._get_pandas_groups(f1), self._get_pandas_groups(f2)
+            k1, k2 = set(groups1), set(groups2)
+
+            # Keys whose raw HDF5 content hashes equal are identical and are never
+            # loaded into pandas; only the remaining keys go through the full comparison
+            identical_items = []
+            changed_items = []
+            for item in k1 & k2:
+                if self._hash_group(groups1[item]) == self._hash_group(groups2[item]):
+                    identical_items.append(item)
+                else:
+                    changed_items.append(item)
+
         different_keys = len(k1 ^ k2)
-        identical_items = []
         identical_name_different_data = []
         identical_name_different_data_dfs = {}
+        shape_mismatches = {}
+        differences = []
+
+        if changed_items:
+            with locked_hdf(pd.HDFStore, Path(path1) / name, 'r') as ref1, locked_hdf(pd.HDFStore, Path(path2) / name, 'r') as ref2:
+                for item in changed_items:
+                    try:
+                        # Shapes are taken from the stored metadata first, so keys
+                        # whose shapes differ are never read
+                        with HDF5_LOCK:
+                            shapes = (self._stored_shape(ref1, item), self._stored_shape(ref2, item))
+                            if None not in shapes and shapes[0] != shapes[1]:
+                                df1 = df2 = None
+                            else:
+                                df1, df2 = ref1[item], ref2[item]
+                                shapes = (df1.shape, df2.shape)
+                        if shapes[0] != shapes[1]:
+                            # Nothing to compare element-wise, only the shapes are reported
+                            identical_name_different_data.append(item)
+                            shape_mismatches[item] = shapes
+                            # The shapes alone make the data maximally different, no values are compared
+                            identical_name_different_data_dfs[item] = {
+                                "mean": np.nan,
+                                "max": np.inf,
+                                "n": 0,
+                                "hist": [0] * (len(REL_DIFF_BIN_EDGES) - 1),
+                                "shapes": shapes,
+                            }
+                            differences.append({"item": item, "shapes": shapes})
+                        elif self._frames_equal(df1, df2):
+                            identical_items.append(item)
+                        else:
+                            identical_name_different_data.append(item)
+                            stats, columns, summary = self._compute_differences(df1, df2)
+                            identical_name_different_data_dfs[item] = summary
+                            differences.append({"item": item, "stats": stats, "columns": columns})
+                    except Exception as e:
+                        differences.append({"item": item, "error": e})
+
+        results = {
+            "different_keys": different_keys,
+            "identical_keys": len(identical_items),
+            "identical_keys_diff_data": len(identical_name_different_data),
+            "identical_name_different_data_dfs": identical_name_different_data_dfs,
+            "shape_mismatches": shape_mismatches,
+            "ref1_keys": list(k1),
+            "ref2_keys": list(k2)
+        }
+        return results, differences
 
-        for item in k1 & k2:
+    def report_changes_hdf(self, name, path1, path2, results, differences):
+        for difference in differences:
+            item = difference["item"]
             try:
-                if ref1[item].equals(ref2[item]):
-                    identical_items.append(item)
-                else:
-                    identical_name_different_data.append(item)
-                    identical_name_different_data_dfs[item] = (ref1[item] - ref2[item]) / ref1[item]
-                    self._compare_and_display_differences(ref1[item], ref2[item], item, name, path1, path2)
+                if "error" in difference:
+                    raise difference["error"]
+                if "shapes" in difference:
+                    shape1, shape2 = difference["shapes"]
+                    print(f"Shape mismatch for key {item} in file {name}: ref1 {shape1}, ref2 {shape2}")
+                    continue
+                self._display_differences(difference["stats"], difference["columns"], item, name, path1, path2)
             except Exception as e:
                 print(f"Error comparing item: {item}")
                 print(e)
 
-        ref1.close()
-        ref2.close()
-
         # Only return results if there are differences
-        if different_keys > 0 or len(identical_name_different_data) > 0:
+        if results["different_keys"] > 0 or results["identical_keys_diff_data"] > 0:
             print("\n" + "=" * 50)  # Add a separator line
             print(f"Summary for {name}:")
-            print(f"Total number of keys- in ref1: {len(k1)}, in ref2: {len(k2)}")
-            print(f"Number of keys with different names in ref1 and ref2: {different_keys}")
-            print(f"Number of keys with same name but different data in ref1 and ref2: {len(identical_name_different_data)}")
-            print(f"Number of totally same keys: {len(identical_items)}")
+            print(f"Total number of keys- in ref1: {len(results['ref1_keys'])}, in ref2: {len(results['ref2_keys'])}")
+            print(f"Number of keys with different names in ref1 and ref2: {results['different_keys']}")
+            print(f"Number of keys with same name but different data in ref1 and ref2: {results['identical_keys_diff_data']}")
+            print(f"Number of totally same keys: {results['identical_keys']}")
             print("=" * 50)  # Add another separator line after the summary
             print()
 
-        return {
-            "different_keys": different_keys,
-            "identical_keys": len(identical_items),
-            "identical_keys_diff_data": len(identical_name_different_data),
-            "identical_name_different_data_dfs": identical_name_different_data_dfs,
-            "ref1_keys": list(k1),
-            "ref2_keys": list(k2)
-        }
+    def _stored_shape(self, store, item):
+        """Shape of a stored key as pandas would load it, read from metadata only.
 
-    def _compare_and_display_differences(self, df1, df2, item, name, path1, path2):
-        abs_diff = np.fabs(df1 - df2)
-        rel_diff = abs_diff / np.maximum(np.fabs(df1), np.fabs(df2))
+        Returns None when the storer does not record enough to tell.
+        """
+        try:
+            storer = store.get_storer(item)
+            if storer.is_table:
+                storer.infer_axes()
+                if 'series' in storer.pandas_kind:
+                    return (int(storer.nrows),)
+                (_, columns), = storer.non_index_axes
+                levels = storer.levels if isinstance(storer.levels, list) else []
+                return (int(storer.nrows), len(columns) - len(levels))
+            if storer.shape is None:
+                return None
+            return tuple(int(n) for n in storer.shape)
+        except Exception:
+            return None
 
+    def _frames_equal(self, df1, df2):
+        """Equality as ``DataFrame.equals``, rejecting on metadata before touching the values."""
+        if type(df1) is not type(df2):
+            return False
+        if isinstance(df1, pd.DataFrame):
+            if not (df1.dtypes.equals(df2.dtypes) and df1.columns.equals(df2.columns)):
+                return False
+            dtypes = set(df1.dtypes)
+        else:
+            if df1.dtype != df2.dtype:
+                return False
+            dtypes = {df1.dtype}
+        if not df1.index.equals(df2.index):
+            return False
+
+        # Single numeric dtype: compare the values in one C loop instead of block by block
+        if len(dtypes) == 1:
+            dtype = dtypes.pop()
+            if isinstance(dtype, np.dtype) and dtype.kind in 'biufc':
+                return np.array_equal(df1.to_numpy(), df2.to_numpy(), equal_nan=dtype.kind in 'fc')
+        return df1.equals(df2)
+
+    def _get_pandas_groups(self, hdf_file):
+        """Map every pandas key in an open h5py file to its HDF5 group."""
+        groups = {}
+
+        def visit(obj_name, obj):
+            if isinstance(obj, h5py.Group) and 'pandas_type' in obj.attrs:
+                groups['/' + obj_name] = obj
+
+        hdf_file.visititems(visit)
+        return groups
+
+    def _hash_group(self, group):
+        """Hash the attributes, layout and raw contents of everything stored under a pandas key.
+
+        pandas keeps column names, index classes and value kinds in HDF5 attributes,
+        so these are hashed along with the datasets.
+        """
+        objects = []
+
+        def visit(obj_name, obj):
+            # PyTables index tables are derived data and are skipped
+            if not (obj_name.startswith('_i_') or '/_i_' in obj_name):
+                objects.append((obj_name, obj))
+
+        with HDF5_LOCK:
+            group.visititems(visit)
+            # The pandas group's own attributes come first, then every object below it
+            contents = [("", self._attrs_bytes(group), [])]
+            for obj_name, obj in objects:
+                if isinstance(obj, h5py.Dataset):
+                    layout = f"{obj_name}:{obj.dtype.str}:{obj.shape}:{obj.chunks}"
+                    contents.append((layout, self._attrs_bytes(obj), self._read_buffers(obj)))
+                else:
+                    contents.append((f"{obj_name}/", self._attrs_bytes(obj), []))
+
+        # hashlib releases the GIL on large buffers, so hashing overlaps across worker threads
+        hasher = hashlib.blake2b(digest_size=16)
+        for layout, attrs, buffers in contents:
+            hasher.update(layout.encode())
+            hasher.update(len(attrs).to_bytes(8, 'little'))
+            hasher.update(attrs)
+            for buffer in buffers:
+                hasher.update(memoryview(buffer).nbytes.to_bytes(8, 'little'))
+                hasher.update(buffer)
+        return hasher.digest()
+
+    def _attrs_bytes(self, obj):
+        """Serialise the attributes of an HDF5 object, sorted by name, for hashing."""
+        serialised = []
+        for attr_name in sorted(obj.attrs):
+            value = obj.attrs[attr_name]
+            if isinstance(value, h5py.Empty):
+                encoded = repr(value).encode()
+            else:
+                value = np.asarray(value)
+                if value.dtype.hasobject:
+                    encoded = repr(value.tolist()).encode()
+                else:
+                    encoded = f"{value.dtype.str}:{value.shape}:".encode() + value.tobytes()
+            for part in (attr_name.encode(), encoded):
+                serialised.append(len(part).to_bytes(8, 'little'))
+                serialised.append(part)
+        return b"".join(serialised)
+
+    def _read_buffers(self, dataset):
+        """Read the contents of a dataset as a list of byte buffers for hashing.
+
+        Chunked datasets are read chunk by chunk exactly as stored on disk, which
+        skips decompression and type conversion. Variable-length data is decoded,
+        since its stored chunks only hold references into the file's heap.
+        """
+        if dataset.shape is None:
+            return []
+        if dataset.chunks is not None and not dataset.dtype.hasobject:
+            dsid = dataset.id
+            # Unallocated chunks read back as the fill value, and chunks are only
+            # equal if they sit at the same position, so both are hashed too
+            buffers = [np.asarray(dataset.fillvalue, dtype=dataset.dtype)]
+            for index in range(dsid.get_num_chunks()):
+                offset = dsid.get_chunk_info(index).chunk_offset
+                filter_mask, chunk = dsid.read_direct_chunk(offset)
+                buffers.append(np.asarray(offset, dtype='<u8'))
+                buffers.append(filter_mask.to_bytes(4, 'little'))
+                buffers.append(chunk)
+            return buffers
+        data = np.asarray(dataset[()])
+        if data.dtype.hasobject:
+            return [np.asarray(value).tobytes() for value in data.flat]
+        return [np.ascontiguousarray(data)]
+
+    def _compute_differences(self, df1, df2):
+        if isinstance(df1, pd.Series):
+            df1, df2 = df1.to_frame(), df2.to_frame()
+        columns = df1.columns
+        a = df1.to_numpy(dtype=np.float64)
+        b = df2.to_numpy(dtype=np.float64)
+
+        abs_sum, abs_max, abs_count, rel_sum, rel_max, rel_count, rel_hist = diff_stats(
+            a, b, REL_DIFF_BIN_EDGES
+        )
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats = {
+                "abs": (abs_sum / abs_count, np.where(abs_count > 0, abs_max, np.nan)),
+                "rel": (rel_sum / rel_count, np.where(rel_count > 0, rel_max, np.nan)),
+            }
+            # Only this summary outlives the call, so the difference arrays are not kept in memory
+            total = rel_count.sum()
+            summary = {
+                "mean": float(rel_sum.sum() / total) if total else np.nan,
+                "max": float(rel_max.max()) if total else np.nan,
+                "n": int(a.size),
+                "hist": rel_hist.tolist(),
+            }
+        return stats, columns, summary
+
+    def _display_differences(self, stats, columns, item, name, path1, path2):
         # Check for differences larger than floating point uncertainty
         FLOAT_UNCERTAINTY = 1e-14
-        max_rel_diff = np.nanmax(rel_diff)  # Using nanmax to handle NaN values
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            max_rel_diff = np.nanmax(stats["rel"][1])  # Using nanmax to handle NaN values
 
         if max_rel_diff > FLOAT_UNCERTAINTY:
             logger.warning(
@@ -216,9 +629,7 @@ class HDFComparator:
             )
 
         print(f"Displaying heatmap for key {item} in file {name} \r")
-        for diff_type, diff in zip(["abs", "rel"], [abs_diff, rel_diff]):
-            print(f"Visualising {'Absolute' if diff_type == 'abs' else 'Relative'} Differences")
-            self._display_difference(diff)
+        self._display_difference(stats, columns)
 
         if self.print_path:
             if path1 != path2:
@@ -228,15 +639,23 @@ class HDFComparator:
                 print(f"Path: {path1}")
 
 
-    def _display_difference(self, diff):
+    def _display_difference(self, stats, columns):
+        index = pd.MultiIndex.from_product([list(stats), ['mean', 'max']])
+        diff = pd.DataFrame(
+            [values for diff_mean_max in stats.values() for values in diff_mean_max],
+            index=index,
+            columns=columns,
+        )
         with pd.option_context('display.max_rows', 100, 'display.max_columns', 10):
-            if isinstance(diff, pd.Series):
-                diff = pd.DataFrame([diff.mean(), diff.max()], index=['mean', 'max'])
-            elif isinstance(diff.index, pd.core.indexes.multi.MultiIndex):
-                diff = diff.reset_index(drop=True)
-            
-            diff = pd.DataFrame([diff.mean(), diff.max()], index=['mean', 'max'])
-            display(diff.style.format('{:.2g}'.format).background_gradient(cmap='Reds'))
+            # Rendering a Styler is expensive and only useful in a notebook
+            if get_ipython() is None or sys.stdout.isatty():
+                print(diff.to_string(float_format='{:.2g}'.format))
+                return
+            styler = diff.style.format('{:.2g}'.format)
+            # Absolute and relative differences are shaded on separate scales
+            for diff_type in stats:
+                styler = styler.background_gradient(cmap='Reds', subset=pd.IndexSlice[diff_type, :])
+            display(styler)
 
 
 class SpectrumSolverComparator:
@@ -255,7 +674,7 @@ class SpectrumSolverComparator:
         for ref_name, file_path in [('Ref1', self.ref1_path), ('Ref2', self.ref2_path)]:
             self.data[ref_name] = {}
             try:
-                with pd.HDFStore(file_path) as hdf:
+                with pd.HDFStore(file_path, mode='r') as hdf:
                     for key in self.spectrum_keys:
                         full_key = f"simulation/spectrum_solver/{key}"
                         self.data[ref_name][key] = {
@@ -463,6 +882,7 @@ class ReferenceComparer:
         self.file_setup = None
         self.diff_analyzer = None
         self.hdf_comparator = None
+        self.changed_paths = None
 
     def setup(self):
         self.file_manager.setup()
@@ -472,7 +892,8 @@ class ReferenceComparer:
         self.file_setup.setup()
         self.ref1_path = self.file_manager.get_temp_path("ref1")
         self.ref2_path = self.file_manager.get_temp_path("ref2")
-        self.dcmp = dircmp(self.ref1_path, self.ref2_path)
+        self.changed_paths = self.file_setup.get_changed_paths()
+        self.dcmp = DirComparison(self.ref1_path, self.ref2_path, changed_paths=self.changed_paths)
 
     def teardown(self):
         self.file_manager.teardown()
@@ -484,27 +905,83 @@ class ReferenceComparer:
         
         # Update test_table_dict with added and deleted keys
         for name, results in self.test_table_dict.items():
+            if results.get("identical_file"):
+                # Identical files are never opened, so their keys are not known
+                continue
             ref1_keys = set(results.get("ref1_keys", []))
             ref2_keys = set(results.get("ref2_keys", []))
             results["added_keys"] = list(ref2_keys - ref1_keys)
             results["deleted_keys"] = list(ref1_keys - ref2_keys)
 
     def compare_hdf_files(self):
-        for root, _, files in os.walk(self.ref1_path):
-            for file in files:
-                file_path = Path(file)
-                if file_path.suffix in ('.h5', '.hdf5'):
-                    rel_path = Path(root).relative_to(self.ref1_path)
-                    ref2_file_path = self.ref2_path / rel_path / file
-                    if ref2_file_path.exists():
-                        self.summarise_changes_hdf(file, root, ref2_file_path.parent)
+        tasks = []
+        for name, root, rel_root in self._iter_hdf(self.ref1_path):
+            ref2_root = os.path.join(self.ref2_path, rel_root)
+            if os.path.exists(os.path.join(ref2_root, name)):
+                tasks.append((name, root, ref2_root, rel_root))
+
+        # Files are compared concurrently, but reported here on the calling
+        # thread in walk order so notebook output is not interleaved
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            comparisons = executor.map(lambda task: self._compare_hdf_file(*task), tasks)
+            for (name, path1, path2, _), comparison in zip(tasks, comparisons):
+                if comparison is None:
+                    self._store_hdf_results(name, path1, {"identical_file": True})
+                    continue
+                results, differences = comparison
+                self.hdf_comparator.report_changes_hdf(name, path1, path2, results, differences)
+                self._store_hdf_results(name, path1, results)
+
+    def _compare_hdf_file(self, name, path1, path2, rel_root):
+        """Compare one HDF file pair, returning None without opening them if the files are identical."""
+        # The directory comparison caches which files differ, so files already
+        # checked for the diff tree are not read a second time
+        dcmp = self._dir_comparison(rel_root)
+        if dcmp is not None and name in dcmp.common_files:
+            identical = name not in dcmp.diff_files
+        else:
+            file1, file2 = os.path.join(path1, name), os.path.join(path2, name)
+            identical = os.path.getsize(file1) == os.path.getsize(file2) and same_file_contents(file1, file2)
+        if identical:
+            return None
+        return self.hdf_comparator.compare_hdf(name, path1, path2)
+
+    def _dir_comparison(self, rel_root):
+        """Return the DirComparison of a directory relative to the references, or None if it was not compared."""
+        dcmp = self.dcmp
+        for part in Path(rel_root).parts:
+            dcmp = dcmp.subdirs.get(part)
+            if dcmp is None:
+                return None
+        return dcmp
+
+    def _iter_hdf(self, root, rel_root=''):
+        """Yield ``(name, directory, relative directory)`` for every HDF file below root.
+
+        Files of a directory come before its subdirectories, in the same order as ``os.walk``.
+        """
+        subdirs = []
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry)
+                elif entry.name.endswith(('.h5', '.hdf5')):
+                    yield entry.name, root, rel_root
+        for entry in subdirs:
+            yield from self._iter_hdf(entry.path, os.path.join(rel_root, entry.name))
 
     def summarise_changes_hdf(self, name, path1, path2):
+        results = self.hdf_comparator.summarise_changes_hdf(name, path1, path2)
+        self._store_hdf_results(name, path1, results)
+
+    def _store_hdf_results(self, name, path1, results):
         self.test_table_dict[name] = {
             "path": get_relative_path(path1, self.file_manager.temp_dir / "ref1")
         }
-        results = self.hdf_comparator.summarise_changes_hdf(name, path1, path2)
         self.test_table_dict[name].update(results)
+        if results.get("identical_file"):
+            return
         
         # Store keys for both references
         self.test_table_dict[name]["ref1_keys"] = results.get("ref1_keys", [])
@@ -533,8 +1010,9 @@ class ReferenceComparer:
                     diff_data = results["identical_name_different_data_dfs"]
                     keys = list(diff_data.keys())
                     # Calculate max relative difference for each key
-                    rel_diffs = [diff_data[key].abs().max().max() for key in keys]
-                    data.append((name, value, keys, rel_diffs))
+                    rel_diffs = [diff_data[key]["max"] for key in keys]
+                    shapes = [diff_data[key].get("shapes") for key in keys]
+                    data.append((name, value, keys, rel_diffs, shapes))
             else:  # "different keys"
                 value = results.get("different_keys", 0)
                 if value > 0:
@@ -553,10 +1031,14 @@ class ReferenceComparer:
         for item in data:
             name = item[0]
             if option == "different keys same name":
-                _, value, keys, rel_diffs = item
+                _, value, keys, rel_diffs, shapes = item
                 if rel_diffs:
-                    max_diff = max(rel_diffs)
-                    normalized_diffs = [diff / max_diff for diff in rel_diffs]
+                    # Keys without a finite difference (shape mismatches) get the darkest colour
+                    max_diff = max((diff for diff in rel_diffs if np.isfinite(diff)), default=0)
+                    normalized_diffs = [
+                        (diff / max_diff if max_diff > 0 else 0.0) if np.isfinite(diff) else 1.0
+                        for diff in rel_diffs
+                    ]
                     colors = [pc.sample_colorscale('Blues', diff)[0] for diff in normalized_diffs]
                 else:
                     colors = ['rgb(220, 220, 255)'] * len(keys)
@@ -571,8 +1053,9 @@ class ReferenceComparer:
                     customdata=rel_diffs,
                     marker_color=colors,
                     hoverinfo='text',
-                    hovertext=[f"{name}<br>Key: {key}<br>Max relative difference: {diff:.2e}<br>(Versions differ by {diff:.1%})" 
-                               for key, diff in zip(keys, rel_diffs)]
+                    hovertext=[f"{name}<br>Key: {key}<br>Shape mismatch: ref1 {shape[0]}, ref2 {shape[1]}" if shape else
+                               f"{name}<br>Key: {key}<br>Max relative difference: {diff:.2e}<br>(Versions differ by {diff:.1%})" 
+                               for key, diff, shape in zip(keys, rel_diffs, shapes)]
                 ))
             else:  # "different keys"
                 _, _, added, deleted = item